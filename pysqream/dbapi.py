@@ -2,19 +2,39 @@
 
 '''
 
-import socket, json, ssl, logging, time, traceback
-from struct import pack, pack_into, unpack, error as struct_error
+import socket, json, ssl, logging, time, traceback, os, array, codecs
+from struct import Struct, pack_into, unpack, error as struct_error
 from datetime import datetime, date, time as t
-from multiprocessing import Pool, Manager
-from mmap import mmap
-from functools import reduce
-from concurrent.futures import ProcessPoolExecutor
+from functools import reduce, lru_cache
+from itertools import compress
+from concurrent.futures import ThreadPoolExecutor
 try:
     import cython
     CYTHON = True
 except:
     CYTHON = False
 
+try:
+    from numba import njit, guvectorize
+    NUMBA = True
+except:
+    NUMBA = False
+
+    def njit(*args, **kwargs):
+        ''' Stand-in for numba's decorators, returns the function unchanged '''
+
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+    guvectorize = njit
+
+try:
+    import orjson
+    _dumps, _loads = lambda obj: orjson.dumps(obj).decode('utf8'), orjson.loads
+except:
+    _dumps, _loads = json.dumps, json.loads
+
 try:
     import pyarrow as pa
     from pyarrow import csv
@@ -23,6 +43,14 @@ try:
 except:
     ARROW = False
 else:
+    # Arrow's jemalloc pool, where pyarrow was built with it, keeps the CSV reader's large buffers from fragmenting
+    # the heap the rest of the process allocates from. ARROW_DEFAULT_MEMORY_POOL still picks Arrow's own choice
+    try:
+        arrow_memory_pool = pa.default_memory_pool() if 'ARROW_DEFAULT_MEMORY_POOL' in os.environ else \
+                            pa.jemalloc_memory_pool()
+    except:
+        arrow_memory_pool = pa.default_memory_pool()
+
     sqream_to_pa = {
         'ftBool':     pa.bool_(),
         'ftUByte':    pa.uint8(),
@@ -37,15 +65,41 @@ else:
         'ftBlob':     pa.utf8()
     }
 
+    # Arrow types of fetched columns, as returned by fetch_arrow()
+    sqream_to_pa_fetched = dict(sqream_to_pa, ftDate=pa.date32(), ftDateTime=pa.timestamp('us'))
+
+    # Numpy types of fetched fixed width columns, as they arrive on the wire
+    sqream_to_np = {
+        'ftBool':     np.bool_,
+        'ftUByte':    np.uint8,
+        'ftShort':    np.int16,
+        'ftInt':      np.int32,
+        'ftLong':     np.int64,
+        'ftFloat':    np.float32,
+        'ftDouble':   np.float64,
+        'ftDate':     np.int32,
+        'ftDateTime': np.int64
+    }
+
 
 __version__ = '3.0.0'
 
 PROTOCOL_VERSION = 7
-BUFFER_SIZE = 100 * int(1e6)  # For setting auto-flushing on netrwork insert
-ROWS_PER_FLUSH = 100000
+ROWS_PER_FLUSH = 100000  # Least rows per network insert chunk
+FLUSH_BYTES_PER_COL = 2 * 1024 * 1024  # Insert chunks grow past ROWS_PER_FLUSH to send about this much per column
+MAX_ROWS_PER_FLUSH = 1000000  # Most rows per network insert chunk
+NVARCHAR_WIDTH_ESTIMATE = 100  # Bytes an nvarchar is assumed to take when sizing insert chunks
 DEFAULT_CHUNKSIZE = 0  # Dummy variable for some jsons
 FETCH_MANY_DEFAULT = 1  # default parameter for fetchmany()
+FETCH_ITER_DEFAULT = 10000  # Least rows per fetchmany() when iterating over a cursor
 VARCHAR_ENCODING = 'ascii'
+HEADER_STRUCT = Struct('<bbq')  # SQream's 10 byte message header - protocol version, text (1) / binary (2), length
+MSG_WAITALL = getattr(socket, 'MSG_WAITALL', 0)  # Not defined on every platform
+IOV_MAX = 1024  # Most buffers a single sendmsg() call accepts on Linux
+try:
+    PACK_THREADS = max(1, int(os.environ.get('SQREAM_PACK_THREADS', 8)))  # Threads packing insert columns, 1 packs serially
+except ValueError:
+    PACK_THREADS = 8
 
 # For encoding data to be sent to SQream using struct.pack() and for type checking by _set_val()
 type_to_letter = {
@@ -85,10 +139,9 @@ def pad_dates(num):
     return ('0' if num < 10 else '') + str(num)
 
 
-def sq_date_to_tuple(sqream_date, date_convert_func=date):
-
-    if sqream_date is None:
-        return None
+@njit('UniTuple(int64, 3)(int64)')
+def _sq_date_to_ymd(sqream_date):
+    ''' Break a SQream date int to a (year, month, day) tuple '''
 
     year = (10000 * sqream_date + 14780) // 3652425
     intermed_1 = 365 * year + year // 4 - year // 100 + year // 400
@@ -103,29 +156,44 @@ def sq_date_to_tuple(sqream_date, date_convert_func=date):
     month = int((intermed_3 + 2) % 12) + 1
     day = int(intermed_2 - (intermed_3 * 306 + 5) // 10 + 1)
 
-    return date_convert_func(year, month, day)
+    return year, month, day
 
 
-def sq_datetime_to_tuple(sqream_datetime, dt_convert_func=datetime):
-    ''' Getting the datetime items involves breaking the long into the date int and time it holds
-        The date is extracted in the above, while the time is extracted here  '''
-
-    if sqream_datetime is None:
-        return None
+@njit('UniTuple(int64, 7)(int64)')
+def _sq_datetime_to_parts(sqream_datetime):
+    ''' Break a SQream datetime long to a (year, month, day, hour, mins, sec, msec) tuple '''
 
     date_part = sqream_datetime >> 32
     time_part = sqream_datetime & 0xffffffff
-    date_part = sq_date_to_tuple(date_part)
+    year, month, day = _sq_date_to_ymd(date_part)
 
     msec = time_part % 1000
     sec = (time_part // 1000) % 60
     mins = (time_part // 1000 // 60) % 60
     hour = time_part // 1000 // 60 // 60
 
-    return dt_convert_func(date_part.year, date_part.month, date_part.day,
-                           hour, mins, sec, msec)
+    return year, month, day, hour, mins, sec, msec
+
+
+def sq_date_to_tuple(sqream_date, date_convert_func=date):
+
+    if sqream_date is None:
+        return None
 
+    return date_convert_func(*_sq_date_to_ymd(sqream_date))
 
+
+def sq_datetime_to_tuple(sqream_datetime, dt_convert_func=datetime):
+    ''' Getting the datetime items involves breaking the long into the date int and time it holds
+        The date is extracted in the above, while the time is extracted here  '''
+
+    if sqream_datetime is None:
+        return None
+
+    return dt_convert_func(*_sq_datetime_to_parts(sqream_datetime))
+
+
+@njit('int64(int64, int64, int64)')
 def date_tuple_to_int(year: int, month: int, day: int) -> int:
 
     mth: int = (month + 9) % 12
@@ -134,6 +202,7 @@ def date_tuple_to_int(year: int, month: int, day: int) -> int:
                                                          5) // 10 + (day - 1)
 
 
+@njit
 def datetime_tuple_to_long(year: int, month: int, day: int, hour: int, minute: int, second: int, msecond: int = 0) -> int:
     ''' self contained to avoid function calling overhead '''
 
@@ -146,6 +215,49 @@ def datetime_tuple_to_long(year: int, month: int, day: int, hour: int, minute: i
     return (date_int << 32) + time_int
 
 
+@guvectorize(['void(int32[:], int32[:], int32[:], int64[:])'], '(n),(n),(n)->(n)')
+def dates_to_ints_batch(years, months, days, res):
+    ''' Batched date_tuple_to_int() over year, month and day arrays '''
+
+    for idx in range(years.shape[0]):
+        res[idx] = date_tuple_to_int(years[idx], months[idx], days[idx])
+
+
+# SQream's date int for 1970-01-01, to shift numpy's days since epoch by
+SQ_EPOCH_DATE = date_tuple_to_int(1970, 1, 1)
+
+
+def sq_dates_to_datetime64(sqream_dates):
+    ''' Vectorized sq_date_to_tuple() - SQream date ints are a day count, so this is only an epoch shift '''
+
+    return (np.frombuffer(sqream_dates, dtype=np.int32) - SQ_EPOCH_DATE).astype('datetime64[D]')
+
+
+def sq_datetimes_to_datetime64(sqream_datetimes):
+    ''' Vectorized sq_datetime_to_tuple(), with the milliseconds set as microseconds the same way '''
+
+    sqream_datetimes = np.frombuffer(sqream_datetimes, dtype=np.int64)
+    days = (sqream_datetimes >> 32) - SQ_EPOCH_DATE
+    secs, msecs = np.divmod(sqream_datetimes & 0xffffffff, 1000)
+
+    return (days * 86400 * 10**6 + secs * 10**6 + msecs).astype('datetime64[us]')
+
+
+def sq_varchars_to_str(sqream_varchars, encoding):
+    ''' Decode a fetched varchar column, viewed as fixed width bytes, without the padding. Numpy decodes ascii
+        itself, and latin-1 is each byte widened to its code point. np.char.decode() would be a Python loop over
+        the items anyway, so other encodings are decoded to a list item by item '''
+
+    width = sqream_varchars.dtype.itemsize
+    codec = codecs.lookup(encoding).name
+    if codec == 'ascii':
+        return np.char.rstrip(sqream_varchars.astype(f'U{width}'))
+    if codec == 'iso8859-1':
+        return np.char.rstrip(sqream_varchars.view(np.uint8).astype(np.uint32).view(f'U{width}'))
+
+    return [item.decode(encoding).rstrip() for item in sqream_varchars.tolist()]
+
+
 def lengths_to_pairs(nvarc_lengths):
     ''' Accumulative sum generator, used for parsing nvarchar columns '''
 
@@ -156,18 +268,30 @@ def lengths_to_pairs(nvarc_lengths):
         idx = new_idx
 
 
+def nvarchar_to_arrow(nvarc_sizes, data, null_bitmap=None):
+    ''' Wrap a fetched nvarchar column as an Arrow StringArray without copying the text.
+        The lengths column is turned to Arrow's offsets, and the utf8 is validated by Arrow '''
 
-def numpy_datetime_str_to_tup(numpy_dt):
-    ''' '1970-01-01T00:00:00.699148800' '''
+    offsets = np.zeros(len(nvarc_sizes) + 1, dtype=np.int32)
+    np.cumsum(np.frombuffer(nvarc_sizes, dtype=np.int32), out=offsets[1:])
+    strings = pa.StringArray.from_buffers(len(nvarc_sizes), pa.py_buffer(offsets), pa.py_buffer(data), null_bitmap)
+    strings.validate(full=True)
 
-    numpy_dt = repr(numpy_dt).split("'")[1]
-    date_part, time_part = numpy_dt.split('T')
-    year, month, day = date_part.split('-')
-    hms, ns = time_part.split('.')
-    hour, mins, sec = hms.split(':')
+    return strings
 
 
-    return year, month, day, hour, mins, sec, ns
+
+def numpy_datetime_str_to_tup(numpy_dt):
+    ''' Break a numpy datetime64 to a (year, month, day, hour, mins, sec, ns) tuple, e.g. 
+        1970-01-01T00:00:00.699148800 -> (1970, 1, 1, 0, 0, 0, 699148800) '''
+
+    # Split at the day, so the nanosecond count only spans the time of day and can't overflow
+    day = np.datetime64(numpy_dt, 'D')
+    secs, ns = divmod(int((numpy_dt - day).astype('timedelta64[ns]').astype(np.int64)), 10**9)
+    hour, secs = divmod(secs, 3600)
+    mins, sec = divmod(secs, 60)
+
+    return _sq_date_to_ymd(int(day.astype(np.int64)) + SQ_EPOCH_DATE) + (hour, mins, sec, ns)
 
 
 
@@ -180,9 +304,6 @@ def numpy_datetime_str_to_tup2(numpy_dt):
     return dt.year, dt.month, dt.day
 
 
-    return year, month, day, hour, mins, sec, ns
-
-
 
 ## Socket related
 #  --------------
@@ -193,6 +314,8 @@ class SQSocket:
     
     def __init__(self, ip, port, use_ssl=False):
         self.ip, self.port, self.use_ssl = ip, port, use_ssl
+        self._hdr_buf = bytearray(10)  # Reused by receive_header()
+        self._rx = bytearray(1 << 20)  # Reused by receive_reused(), grown on demand
         self._setup_socket(ip, port)
    
     
@@ -240,6 +363,23 @@ class SQSocket:
         #    raise BrokenPipeError('No connection to SQream. Try reconnecting')
 
 
+    def send_buffers(self, buffers):
+        ''' Send a sequence of buffers with as few syscalls as possible - scatter/gather sendmsg()
+            calls on plain sockets, a single send of the joined buffers on SSL ones '''
+
+        if self.use_ssl or not hasattr(self.s, 'sendmsg'):
+            return self.s.sendall(b''.join(buffers))
+
+        views = [memoryview(buf).cast('B') for buf in buffers]
+        while views:
+            sent = self.s.sendmsg(views[:IOV_MAX])
+            # Drop what was sent completely and slice the remainder of a partially sent buffer
+            while views and sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            if views:
+                views[0] = views[0][sent:]
+
+
     def close(self):
 
         return self.s.close()
@@ -266,42 +406,67 @@ class SQSocket:
         ''' Read a specific amount of bytes from a given socket '''
 
         data = bytearray(byte_num)
+        self._receive_into(data, timeout)
+
+        return data
+
+
+    def receive_reused(self, byte_num, timeout=None):
+        ''' Read a specific amount of bytes into a scratch buffer shared across calls. 
+            Returns a memoryview valid until the next call - use .tobytes() to keep the data '''
+
+        if len(self._rx) < byte_num:
+            # Views handed out earlier keep the old buffer alive, so replace rather than resize
+            self._rx = bytearray(max(2 * len(self._rx), byte_num))
+
+        data = memoryview(self._rx)[:byte_num]
+        self._receive_into(data, timeout)
+
+        return data
+
+
+    def receive_header(self):
+        ''' Read SQream's 10 byte message header into a reused buffer, valid until the next header is read '''
+
+        self._receive_into(self._hdr_buf)
+
+        return self._hdr_buf
+
+
+    def _receive_into(self, data, timeout=None):
+        ''' Fill a given buffer from the socket '''
+
         view = memoryview(data)
-        total = 0
 
         if timeout:
             self.s.settimeout(timeout)
-        
+
+        # A blocking plain socket fills the whole buffer in a single call. SSL sockets don't take flags
+        if view and not self.use_ssl:
+            view = view[self.s.recv_into(view, len(view), MSG_WAITALL):]
+
         while view:
             # Get whatever the socket gives and put it inside the bytearray
             received = self.s.recv_into(view)
             if received == 0:
                 raise ConnectionRefusedError('SQreamd connection interrupted - 0 returned by socket')
             view = view[received:]
-            total += received
 
         if timeout:
             self.s.settimeout(None)
-            
-        
-        return data
 
 
     def get_response(self, is_text_msg=True):
         ''' Get answer JSON string from SQream after sending a relevant message '''
 
         # Getting 10-byte response header back
-        header = self.receive(10)
-        server_protocol = header[0]
+        server_protocol, bytes_or_text, message_len = HEADER_STRUCT.unpack_from(self.receive_header())
         if server_protocol not in (6, 7):
             raise Exception(
                 f'Protocol mismatch, client version - {PROTOCOL_VERSION}, server version - {server_protocol}'
             )
-        # bytes_or_text =  header[1]
-        message_len = unpack('q', header[2:10])[0]
 
-        return self.receive(message_len).decode(
-            'utf8') if is_text_msg else self.receive(message_len)
+        return str(self.receive_reused(message_len), 'utf8') if is_text_msg else self.receive(message_len)
 
     
     # Non socket aux. functionality
@@ -310,8 +475,7 @@ class SQSocket:
     def generate_message_header(self, data_length, is_text_msg=True, protocol_version=PROTOCOL_VERSION):
         ''' Generate SQream's 10 byte header prepended to any message '''
 
-        return pack('bb', protocol_version, 1 if is_text_msg else 2) + pack(
-            'q', data_length)
+        return HEADER_STRUCT.pack(protocol_version, 1 if is_text_msg else 2, data_length)
 
 
     def validate_response(self, response, expected):
@@ -327,68 +491,207 @@ class SQSocket:
 ## Buffer setup and functionality
 #  ------------------------------
 
-manager = Manager()
-buf_maps, buf_views = [], []
-
-
 class ColumnBuffer:
     ''' Buffer holding packed columns to be sent to SQream '''
 
-    def __init__(self, size=BUFFER_SIZE):
-        global buf_maps, buf_views
-        
-
-    def clear(self):
-        if buf_maps:
-            [buf_map.close() for buf_map in buf_maps[0]]
-
-
-    def init_buffers(self, col_sizes, col_nul):
-
-        self.clear()
-        buf_maps = [mmap(-1, ((1 if col_nul else 0)+(size if size!=0 else 104)) * ROWS_PER_FLUSH) for size in col_sizes]
-        buf_views = [memoryview(buf_map) for buf_map in buf_maps]
-        self.pool = Pool()
+    def __init__(self):
+        # Packing is mostly numpy / struct work, so threads share the columns instead of pickling them to processes
+        self.executor = ThreadPoolExecutor(max_workers=PACK_THREADS) if PACK_THREADS > 1 else None
+        # Fixed width columns are packed into these, reused across chunks. Two are alternated so a chunk can be
+        # packed while the previous one is still being sent
+        self._outs, self._out_idx = [bytearray(), bytearray()], 0
 
     
     def pack_columns(self, cols, capacity, col_types, col_sizes, col_nul, col_tvc):
         ''' Packs the buffer starting a given index with the column. 
             Returns number of bytes packed '''
 
-        pool_params = zip(cols, range(len(col_types)), col_types,
-                          col_sizes, col_nul, col_tvc)
-        # To use multiprocess type packing, we call a top level function with a single tuple parameter
+        # Fixed width columns are laid out back to back in one buffer and packed in place. Numpy columns that
+        # already hold SQream's data only have their null bytes there, their own memory is sent as is.
+        # Variable length columns get buffers of their own
+        regions, as_is, total = [], [], 0
+        for col, col_type, size, nullable, tvc in zip(cols, col_types, col_sizes, col_nul, col_tvc):
+            as_is.append(_ndarray_is_sendable(col, col_type, nullable))
+            if as_is[-1]:
+                regions.append((total, total + (capacity if nullable else 0)))
+            elif tvc or (ARROW and isinstance(col, np.ndarray) and col.dtype != object and not (
+                    col.dtype.kind in 'biuf' and col_type not in ('ftVarchar', 'ftDate', 'ftDateTime') or
+                    col.dtype.kind == 'M' and col_type in ('ftDate', 'ftDateTime'))):
+                regions.append(None)
+                continue
+            else:
+                regions.append((total, total + capacity * ((1 if nullable else 0) + size)))
+            total = regions[-1][1]
+
+        # Column packing relies on zeroed null bytes, which may be left over from an earlier chunk
+        self._out_idx ^= 1
+        if len(self._outs[self._out_idx]) < total:
+            self._outs[self._out_idx] = bytearray(total)
+        else:
+            zeros = bytes(capacity)
+            for region, nullable in zip(regions, col_nul):
+                if region and nullable:
+                    self._outs[self._out_idx][region[0]:region[0] + capacity] = zeros
+
+        out = memoryview(self._outs[self._out_idx])
+        pool_params = [(col, idx, col_type, size, nullable, tvc, out[slice(*region)] if region else None)
+                       for idx, (col, col_type, size, nullable, tvc, region, sendable) in enumerate(
+                           zip(cols, col_types, col_sizes, col_nul, col_tvc, regions, as_is))
+                       if not sendable]
+        # Columns are packed in parallel by a top level function with a single tuple parameter
         try:
-            packed_cols = self.pool.map(_pack_column, pool_params)  # buf_end_indices
+            packed_cols = iter(list(self.executor.map(_pack_column, pool_params) if self.executor else
+                                    map(_pack_column, pool_params)))
         except Exception as e:
-            printdbg("Original error from pool.map: ", e)
+            printdbg("Original error from packing: ", e)
             raise ProgrammingError(
                 "Error packing columns. Check that all types match the respective column types"
             )
 
-        return packed_cols
+        # Each run of adjacent in place columns is sent as one contiguous segment. These are views of the
+        # reused buffers, valid until the call after next
+        segments, run_start = [], None
+        for col, region, sendable in zip(cols, regions, as_is):
+            if region is not None:
+                run_start, run_end = region[0] if run_start is None else run_start, region[1]
+            if region is None or sendable:
+                if run_start is not None and run_end > run_start:
+                    segments.append(out[run_start:run_end])
+                run_start = None
+                segments.append(memoryview(np.ma.getdata(col)).cast('B') if sendable else next(packed_cols))
+            else:
+                next(packed_cols)
+        if run_start is not None:
+            segments.append(out[run_start:run_end])
+
+        return segments
 
 
     def close(self):
-        self.clear()
-        self.pool.close()
-        self.pool.join()
+        if self.executor:
+            self.executor.shutdown()
+
+
+
+def _ndarray_null_mask(col):
+    ''' Boolean mask of the missing items in a numpy column, by the column's dtype '''
+
+    if col.dtype.kind == 'f':
+        return np.isnan(col)
+    if col.dtype.kind == 'M':
+        return np.isnat(col)
+    if col.dtype.kind == 'S':
+        return col == b''
+    if col.dtype.kind == 'O':
+        return np.equal(col, None)
+
+    return np.zeros(len(col), dtype=bool)
+
+
+def _ndarray_is_sendable(col, col_type, nullable):
+    ''' Whether a numpy column's memory already is SQream's data for it - a contiguous array of the column's
+        little endian type, with no nulls to swap out. Used by ColumnBuffer.pack_columns() '''
+
+    if not (ARROW and isinstance(col, np.ndarray)) or col_type not in (
+            'ftBool', 'ftUByte', 'ftShort', 'ftInt', 'ftLong', 'ftFloat', 'ftDouble'):
+        return False
+
+    data = np.ma.getdata(col)
+    if data.dtype != np.dtype('<' + type_to_letter[col_type]) or not data.flags.c_contiguous:
+        return False
+
+    return not nullable or not (np.ma.is_masked(col) if isinstance(col, np.ma.MaskedArray) else
+                                _ndarray_null_mask(data).any())
+
+
+# date.toordinal() counts days from 0001-01-01, SQream from 0000-03-01
+SQ_ORDINAL_OFFSET = SQ_EPOCH_DATE - date(1970, 1, 1).toordinal()
+SQ_NULL_ORDINAL = date(1900, 1, 1).toordinal()
+
 
+def _list_dates_to_sq_ints(col, capacity):
+    ''' date_tuple_to_int() over a list of dates or datetimes, Nones become 1900-01-01. Ordinals are the wall
+        clock date timetuple() gives, aware datetimes included. None if the column holds anything else '''
+
+    try:
+        ordinals = np.fromiter(map(date.toordinal, col), dtype=np.int64, count=capacity)
+    except TypeError:  # Nones, or non dates
+        try:
+            ordinals = np.fromiter((SQ_NULL_ORDINAL if deit is None else date.toordinal(deit) for deit in col),
+                                   dtype=np.int64, count=capacity)
+        except TypeError:
+            return None
+
+    return ordinals + SQ_ORDINAL_OFFSET
+
+
+def _list_datetimes_to_sq_longs(col, capacity):
+    ''' datetime_tuple_to_long() over a list of datetimes in a single pass, Nones become 1900-01-01. Taken from
+        the wall clock fields like timetuple() does, aware datetimes included. None if the column holds anything else '''
+
+    try:
+        return np.fromiter(
+            ((SQ_NULL_ORDINAL + SQ_ORDINAL_OFFSET) << 32 if dt is None else
+             ((dt.toordinal() + SQ_ORDINAL_OFFSET) << 32) +
+             (dt.hour * 3600 + dt.minute * 60 + dt.second) * 1000 + dt.microsecond // 1000 for dt in col),
+            dtype=np.int64, count=capacity)
+    except (TypeError, AttributeError):
+        return None
+
+
+def _dates_to_sq_ints(col):
+    ''' Vectorized date_tuple_to_int() over a datetime64 column, NaTs become 1900-01-01 '''
+
+    days = np.array(col, dtype='datetime64[D]')
+    days[np.isnat(days)] = np.datetime64('1900-01-01')
+
+    return days.astype(np.int64) + SQ_EPOCH_DATE
+
+
+def _datetimes_to_sq_longs(col):
+    ''' Vectorized datetime_tuple_to_long() over a datetime64 column, NaTs become 1900-01-01 '''
+
+    usecs = np.array(col, dtype='datetime64[us]')
+    usecs[np.isnat(usecs)] = np.datetime64('1900-01-01')
+    days, day_usecs = np.divmod(usecs.astype(np.int64), 86400 * 10**6)
+
+    return ((days + SQ_EPOCH_DATE) << 32) + day_usecs // 1000
 
 
-## A top level packing function for Python's MP compatibility
+@lru_cache(maxsize=128)
+def _build_description(col_names, col_nul, col_type_tups):
+    ''' Cursor description entries for a result's columns, cached for repeating schemas. Used by _fill_description() '''
+
+    description = []
+    for col_name, col_nullalbe, col_type_tup in zip(col_names, col_nul, col_type_tups):
+        type_code = typecodes[
+            col_type_tup[0]]  # Convert SQream type to DBAPI identifier
+        display_size = internal_size = col_type_tup[
+            1]  # Check if other size is available from API
+        precision = None
+        scale = None
+
+        description.append(
+            (col_name, type_code, display_size, internal_size, precision,
+             scale, col_nullalbe))
+
+    return tuple(description)
+
+
+## A top level packing function, mapped over the columns by ColumnBuffer.pack_columns()
 def _pack_column(col_tup, return_actual_data = True):
     ''' Packs the buffer starting a given index with the column. 
         Returns number of bytes packed '''
 
-    col, col_idx, col_type, size, nullable, tvc = col_tup
+    col, col_idx, col_type, size, nullable, tvc, out = col_tup
     capacity = len(col)
     buf_idx = 0
-    buf_map =  mmap(-1, ((1 if nullable else 0)+(size if size!=0 else 104)) * ROWS_PER_FLUSH)
-    buf_view = memoryview(buf_map) 
+    # Exact size of the fixed width parts - variable length strings are appended past its end.
+    # Fixed width columns can be handed a zeroed slice of a shared buffer to be packed in place
+    buf = out if out is not None else bytearray(capacity * ((1 if nullable else 0) + (4 if tvc else 0) + size))
 
     def pack_exception(e):
-        ''' Allowing to return traceback info from parent process when using mp.Pool on _pack_column
+        ''' Allowing to return traceback info from the packing thread of _pack_column
             [add link]
         '''
         e.traceback = traceback.format_exc()
@@ -396,109 +699,184 @@ def _pack_column(col_tup, return_actual_data = True):
             f'Trying to insert unsuitable types to column number {col_idx + 1} of type {col_type}'
         )
 
+    # Arrow string arrays already hold nvarchar's data - the utf8 back to back, delimited by an offsets buffer
+    if ARROW and tvc and isinstance(col, pa.StringArray):
+        offsets = np.frombuffer(col.buffers()[1], dtype=np.int32, count=capacity + 1, offset=4 * col.offset)
+        lengths = np.diff(offsets)
+        null_mask = col.is_null().to_numpy(zero_copy_only=False)
+        # Arrow allows nulls to span data, which would have to be skipped
+        if not lengths[null_mask].any():
+            if nullable and null_mask.any():
+                buf[buf_idx:buf_idx + capacity] = null_mask.view(np.uint8).data
+            buf_idx += capacity if nullable else 0
+            buf[buf_idx:buf_idx + 4 * capacity] = lengths.astype('<i4').data
+            buf_idx += 4 * capacity
+            data_len = int(offsets[-1] - offsets[0])
+            if data_len:
+                buf[buf_idx:buf_idx + data_len] = memoryview(col.buffers()[2])[offsets[0]:offsets[-1]]
+            buf_idx += data_len
+
+            return memoryview(buf)[0:buf_idx] if return_actual_data else (0, buf_idx)
+        col = col.to_pylist()
+
+    # Object arrays, like the columns of transposed rows, are packed as the Python objects they hold. So are str
+    # arrays, whose encoded lengths numpy doesn't know
+    if ARROW and isinstance(col, np.ndarray) and col.dtype.kind in 'OU':
+        col = col.tolist()
+
     # Numpy array for column
     if ARROW and isinstance(col, np.ndarray):
-        # Pack null column if applicable
+        # Masked arrays carry their nulls in the mask, otherwise they're told by the dtype's missing value
+        null_mask = np.ma.getmaskarray(col) if isinstance(col, np.ma.MaskedArray) else None
+        col = np.ma.getdata(col)
+
+        # Pack null column if applicable. The buffer starts zeroed, so a column without nulls is skipped
         if nullable:
-            pack_into(f'{capacity}b', buf_view, buf_idx,
-                      *[1 if item in (np.nan, b'') else 0 for item in col])
+            null_mask = _ndarray_null_mask(col) if null_mask is None else null_mask
+            if null_mask.any():
+                buf[buf_idx:buf_idx + capacity] = null_mask.view(np.uint8).data
             buf_idx += capacity
 
             # Replace Nones with appropriate placeholder
             if 'S' in repr(col.dtype):    # already b''?
                 pass
-            elif 'U' in repr(col.dtype):
-                pass
-            else:
-                # Swap out the nans
-                col[col == np.nan] = 0
+            elif col.dtype.kind == 'M':
+                pass     # NaTs are replaced when converted to SQream dates below
+            elif null_mask.any():
+                # Swap out the nans, on a copy - the array may be read only, and is the caller's anyway
+                col = np.where(null_mask, np.zeros(1, dtype=col.dtype), col)
 
-        # Pack nvarchar length column if applicable
+        # Pack nvarchar length column if applicable, byte strings being taken as utf8
         if tvc:
-            buf_map.seek(buf_idx)
-            lengths_as_bytes = np.vectorize(len)(col).astype('int32').tobytes()
-            buf_map.write(lengths_as_bytes)
+            if col.dtype.kind != 'S':
+                pack_exception(TypeError(f'Can not convert {col.dtype} array to {col_type}'))
+            lengths_as_bytes = np.char.str_len(col).astype('<i4').tobytes()
+            buf[buf_idx:buf_idx + len(lengths_as_bytes)] = lengths_as_bytes
             buf_idx += len(lengths_as_bytes)
 
         # Pack the actual data
-        if 'U' in repr(col.dtype):
-            packed_strings = ''.join(col).encode('utf8')
-            buf_map.seek(buf_idx)
-            buf_map.write(packed_strings)
-            buf_idx += len(packed_strings)
-            print (f'unicode strings: {packed_strings}')
-        else:
-            packed_np = col.tobytes()
-            buf_map.seek(buf_idx)
-            buf_map.write(packed_np)
+        if col.dtype.kind == 'M' and col_type in ('ftDate', 'ftDateTime'):
+            packed_np = (_dates_to_sq_ints(col).astype(np.int32) if col_type == 'ftDate' else
+                         _datetimes_to_sq_longs(col)).tobytes()
+            buf[buf_idx:buf_idx + len(packed_np)] = packed_np
+            buf_idx += len(packed_np)
+        elif col.dtype.kind in 'biuf' and col_type in ('ftBool', 'ftUByte', 'ftShort', 'ftInt', 'ftLong', 'ftFloat', 'ftDouble'):
+            # Numbers are copied by numpy straight into the buffer, converted to the column's little endian type
+            sq_dtype = np.dtype('<' + type_to_letter[col_type])
+            if not np.can_cast(col.dtype, sq_dtype, 'same_kind') or (
+                    sq_dtype.kind in 'iu' and len(col) and col.dtype.kind != 'b' and
+                    (col.min() < np.iinfo(sq_dtype).min or col.max() > np.iinfo(sq_dtype).max)):
+                pack_exception(TypeError(f'Can not convert {col.dtype} array to {col_type}'))
+            np.frombuffer(buf, dtype=sq_dtype, count=capacity, offset=buf_idx)[:] = col
+            buf_idx += capacity * size
+        elif col.dtype.kind == 'S' and (tvc or col_type == 'ftVarchar' and col.dtype.itemsize == size):
+            # Byte strings are sent as they are, back to back for nvarchar or at varchar's exact width
+            packed_np = b''.join(col.tolist()) if tvc else col.tobytes()
+            buf[buf_idx:buf_idx + len(packed_np)] = packed_np
             buf_idx += len(packed_np)
+        else:
+            # Anything else would be sent at the wrong size, throwing SQream off the rest of the message
+            pack_exception(TypeError(f'Can not convert {col.dtype} array to {col_type} of size {size}'))
 
 
-        return buf_map[0:buf_idx] if return_actual_data else (0, buf_idx)
+        return memoryview(buf)[0:buf_idx] if return_actual_data else (0, buf_idx)
 
 
     # Pack null column if applicable
     type_code = type_to_letter[col_type]
 
-    # If a text column, replace and pack in adavnce to see if the buffer is sufficient
+    # Checked ahead of anything else, so a column without Nones is packed as it is - converting it first
+    # costs more than the check
+    try:
+        has_nulls = None in col
+    except Exception as e:  # Items that fail comparing to None
+        pack_exception(e)
+
+    # If a text column, replace and pack in adavnce. Nones are packed as empty strings, and the lengths
+    # column is taken from the encoded strings in a C loop
     if col_type == 'ftBlob':
         try:
-            encoded_col = [strn.encode('utf8') if strn is not None else b''
-                for strn in col
-            ]
+            encoded_col = ([strn.encode('utf8') if strn is not None else b'' for strn in col] if has_nulls else
+                           [strn.encode('utf8') for strn in col])
         except AttributeError as e:  # Non strings will not have .encode()
             pack_exception(e)
-        else:
-            packed_strings = b''.join(encoded_col)
-
-        needed_buf_size = len(packed_strings) + 5* capacity
-        
-        # Resize the buffer if not enough space for the current strings
-        if needed_buf_size > len(buf_map):
-            buf_view.release()
-            buf_map.resize(needed_buf_size)
-            buf_view = memoryview(buf_map)
+        packed_strings = b''.join(encoded_col)
+        nvarc_lengths = array.array('i', list(map(len, encoded_col)))
 
+    packed_col = None
+    nones_swapped = False
     if nullable:
-        pack_into(f'{capacity}b', buf_view, buf_idx,
-                  *[1 if item is None else 0 for item in col])
+        # The buffer starts zeroed, so there's nothing to pack for a column without nulls
+        if has_nulls:
+            if col_type in ('ftBool', 'ftUByte', 'ftShort', 'ftInt', 'ftLong', 'ftFloat', 'ftDouble'):
+                # A single pass marks the nulls and builds the values with their placeholders
+                null_bytes, vals = bytearray(capacity), [0] * capacity
+                for idx, item in enumerate(col):
+                    if item is None:
+                        null_bytes[idx] = 1
+                    else:
+                        vals[idx] = item
+                buf[buf_idx:buf_idx + capacity] = null_bytes
+                col, nones_swapped = vals, True
+            else:
+                buf[buf_idx:buf_idx + capacity] = bytes([item is None for item in col])
         buf_idx += capacity
 
 
     # Replace Nones with appropriate placeholder - this affects the data itself
     if col_type == 'ftBlob':
-        pass     # Handled preemptively due to allow possible buffer resizing
+        pass     # Handled preemptively, the lengths column is packed from the encoded strings
 
     elif col_type == 'ftVarchar':
         try:
-            col = (strn.encode(VARCHAR_ENCODING)[:size].ljust(size, b' ')
-                   if strn is not None else b''.ljust(size, b' ')
-                   for strn in col)
+            packed_strings = b''.join([strn.encode(VARCHAR_ENCODING)[:size].ljust(size, b' ')
+                                       if strn is not None else b''.ljust(size, b' ') for strn in col] if has_nulls else
+                                      [strn.encode(VARCHAR_ENCODING)[:size].ljust(size, b' ') for strn in col])
         except AttributeError as e:  # Non strings will not have .encode()
             pack_exception(e)
-        else:
-            packed_strings = b''.join(col)
 
     elif col_type == 'ftDate':
-        try:
-            col = (date_tuple_to_int(*deit.timetuple()[:3])
-                   if deit is not None else date_tuple_to_int(1900, 1, 1)
-                   for deit in col)
-        except AttributeError as e:  # Non date/times will not have .timetuple()
-            pack_exception(e)
+        sq_dates = _list_dates_to_sq_ints(col, capacity) if ARROW else None
+        if sq_dates is not None:
+            packed_col = sq_dates.astype(np.int32).tobytes()
+        else:
+            try:
+                if NUMBA:
+                    col = dates_to_ints_batch(*np.array(
+                        [deit.timetuple()[:3] if deit is not None else (1900, 1, 1) for deit in col],
+                        dtype=np.int32).reshape(-1, 3).T)
+                else:
+                    col = (date_tuple_to_int(*deit.timetuple()[:3])
+                           if deit is not None else date_tuple_to_int(1900, 1, 1)
+                           for deit in col)
+            except AttributeError as e:  # Non date/times will not have .timetuple()
+                pack_exception(e)
 
     elif col_type == 'ftDateTime':
-        try:
-            col = (datetime_tuple_to_long(*(dt.timetuple()[:6] + (dt.microsecond, )))
-                   if dt is not None else datetime_tuple_to_long(
-                       1900, 1, 1, 0, 0, 0) for dt in col
-                   )
-        except AttributeError as e:
-            pack_exception(e)
+        sq_datetimes = _list_datetimes_to_sq_longs(col, capacity) if ARROW else None
+        if sq_datetimes is not None:
+            packed_col = sq_datetimes.tobytes()
+        else:
+            try:
+                col = (datetime_tuple_to_long(*(dt.timetuple()[:6] + (dt.microsecond, )))
+                       if dt is not None else datetime_tuple_to_long(
+                           1900, 1, 1, 0, 0, 0) for dt in col
+                       )
+            except AttributeError as e:
+                pack_exception(e)
 
     elif col_type in ('ftBool', 'ftUByte', 'ftShort', 'ftInt', 'ftLong',
                       'ftFloat', 'ftDouble'):
-        col = (num if num is not None else 0 for num in col)
+        if has_nulls and not nones_swapped:
+            col = (num if num is not None else 0 for num in col)
+
+        # array converts the items in a C loop, without expanding the column to pack_into() arguments.
+        # It has no bool type, which stays with pack_into() to keep '?' semantics
+        if col_type != 'ftBool':
+            try:
+                packed_col = array.array(type_code, col).tobytes()
+            except (TypeError, OverflowError) as e:
+                pack_exception(e)
 
     else:
         raise ProgrammingError(f'Bad column type passed: {col_type}')
@@ -506,25 +884,46 @@ def _pack_column(col_tup, return_actual_data = True):
 
     # Pack nvarchar length column if applicable
     if tvc:
-        pack_into(f'{capacity}i', buf_view, buf_idx,
-                  *[len(string) for string in encoded_col])
+        buf[buf_idx:buf_idx + 4 * capacity] = nvarc_lengths
         buf_idx += 4 * capacity
 
 
     # Done preceding column handling, pack the actual data
     if col_type in ('ftVarchar', 'ftBlob'):
-        buf_map.seek(buf_idx)
-        buf_map.write(packed_strings)
+        buf[buf_idx:buf_idx + len(packed_strings)] = packed_strings
         buf_idx += len(packed_strings)
+    elif packed_col is not None:
+        buf[buf_idx:buf_idx + len(packed_col)] = packed_col
+        buf_idx += len(packed_col)
     else:
         try:
-            pack_into(f'{capacity}{type_code}', buf_view, buf_idx, *col)
+            pack_into(f'{capacity}{type_code}', buf, buf_idx, *col)
         except struct_error as e:
             pack_exception(e)
 
         buf_idx += capacity * size
 
-    return buf_map[0:buf_idx] if return_actual_data else (0, buf_idx)
+    return memoryview(buf)[0:buf_idx] if return_actual_data else (0, buf_idx)
+
+
+def _arrow_to_numpy(col_tup):
+    ''' Get the numpy representation of an Arrow column for quick packing - nvarchar strings stay in Arrow.
+        Used by csv_to_table() '''
+
+    col_type, col = col_tup
+    if col_type == 'ftBlob' and isinstance(col, pa.StringArray):
+        return col  # Packed from Arrow's own buffers
+    if col_type in  ('ftVarchar', 'ftBlob', 'ftDate', 'ftDateTime'):
+        # Timestamps come as datetime64 with NaT nulls, strings as an object array of str / None
+        return col.to_numpy(zero_copy_only=False)
+    if col.null_count == 0 and col_type != 'ftBool':
+        # Wraps Arrow's own buffer, nothing is copied
+        return col.to_numpy(zero_copy_only=True, writable=False)
+
+    # Arrow's nulls become the mask of a masked array, bools are unpacked from Arrow's bits
+    return np.ma.masked_array(
+        col.fill_null(False if col_type == 'ftBool' else 0).to_numpy(zero_copy_only=False),
+        mask=col.is_null().to_numpy(zero_copy_only=False))
 
 
 class Connection:
@@ -534,7 +933,8 @@ class Connection:
 
     def __init__(self, ip, port, clustered, use_ssl=False, base_connection=True, reconnect_attempts=3, reconnect_interval=10):
 
-        self.buffer = ColumnBuffer(BUFFER_SIZE)  # flushing buffer every BUFFER_SIZE bytes
+        self.buffer = ColumnBuffer()
+        self.sender = ThreadPoolExecutor(max_workers=1)  # Sends an insert chunk while the next one is packed
         self.row_size = 0
         self.rows_per_flush = 0
         self.stmt_id = None  # For error handling when called out of order
@@ -547,6 +947,7 @@ class Connection:
         self.arraysize = FETCH_MANY_DEFAULT
         self.rowcount = -1    # DB-API property
         self.more_to_fetch = None
+        self.table_schemas = {}  # Table name to its (column names, column types), cached by csv_to_table()
 
         if self.base_connection:
             self.cursors = []
@@ -590,8 +991,9 @@ class Connection:
     def _send_string(self, json_cmd, get_response=True, is_text_msg=True, sock=None):
         ''' Encode a JSON string and send to SQream. Optionally get response '''
 
-        # Generating the message header, and sending both over the socket
-        self.s.send(self.s.generate_message_header(len(json_cmd)) + json_cmd.encode('utf8'))
+        # Generating the message header, and sending both over the socket. The length is in bytes, not characters
+        json_cmd = json_cmd.encode('utf8')
+        self.s.send(self.s.generate_message_header(len(json_cmd)) + json_cmd)
 
         if get_response:
             return self.s.get_response(is_text_msg)
@@ -602,9 +1004,9 @@ class Connection:
 
         self.database, self.username, self.password, self.service = database, username, password, service
         res = self._send_string(
-            f'{{"username":"{username}", "password":"{password}", "connectDatabase":"{database}", "service":"{service}"}}'
+            _dumps({"username": username, "password": password, "connectDatabase": database, "service": service})
         )
-        res = json.loads(res)
+        res = _loads(res)
         try:
             self.connection_id = res['connectionId']
         except KeyError as e:
@@ -640,13 +1042,13 @@ class Connection:
 
         self.more_to_fetch = True    
 
-        self.stmt_id = json.loads(self._send_string('{"getStatementId" : "getStatementId"}'))["statementId"]
+        self.stmt_id = _loads(self._send_string('{"getStatementId" : "getStatementId"}'))["statementId"]
         
-        stmt = json.dumps({"prepareStatement": stmt, "chunkSize": DEFAULT_CHUNKSIZE})
+        stmt = _dumps({"prepareStatement": stmt, "chunkSize": DEFAULT_CHUNKSIZE})
         res = self._send_string(stmt)
 
         self.s.validate_response(res, "statementPrepared")
-        self.lb_params = json.loads(res)
+        self.lb_params = _loads(res)
         if self.lb_params.get('reconnect'):  # Reconnect exists and issued, otherwise False / None
 
             # Close socket, open a new socket with new port/ip sent be the reconnect response
@@ -655,22 +1057,21 @@ class Connection:
                 if self.use_ssl else self.lb_params['port'])
 
             # Send reconnect and reconstruct messages
-            reconnect_str = '{{"service": "{}", "reconnectDatabase":"{}", "connectionId":{}, "listenerId":{},"username":"{}", "password":"{}"}}'.format(
-                self.service, self.database, self.connection_id,
-                self.lb_params['listener_id'], self.username, self.password)
+            reconnect_str = _dumps({"service": self.service, "reconnectDatabase": self.database,
+                                    "connectionId": self.connection_id, "listenerId": self.lb_params['listener_id'],
+                                    "username": self.username, "password": self.password})
             self._send_string(reconnect_str)
-            self._send_string('{{"reconstructStatement": {}}}'.format(
-                self.stmt_id))
+            self._send_string(_dumps({"reconstructStatement": self.stmt_id}))
 
         # Reconnected/reconstructed if needed,  send  execute command
         self._send_string('{"execute" : "execute"}')
 
         # Send queryType message/s
-        res = json.loads(self._send_string('{"queryTypeIn": "queryTypeIn"}'))
+        res = _loads(self._send_string('{"queryTypeIn": "queryTypeIn"}'))
         self.column_list = res.get('queryType', '')
 
         if not self.column_list:
-            res = json.loads(
+            res = _loads(
                 self._send_string('{"queryTypeOut" : "queryTypeOut"}'))
             self.column_list = res.get('queryTypeNamed', '')
             if not self.column_list:
@@ -698,21 +1099,28 @@ class Connection:
             self.col_sizes = [type_tup[1] for type_tup in self.col_type_tups]
             self.row_size = sum(self.col_sizes) + sum(
                 self.col_nul) + 4 * sum(self.col_tvc)
-            self.rows_per_flush = ROWS_PER_FLUSH
-            self.buffer.init_buffers(self.col_sizes, self.col_nul)
+            # Narrow columns would make for many small sends, each paying its framing and syscall (and TLS record)
+            # overhead - size chunks by the average bytes a column takes per row instead. Nvarchar's size
+            # doesn't tell its length, so they're charged an estimate
+            est_row_size = self.row_size + NVARCHAR_WIDTH_ESTIMATE * sum(self.col_tvc)
+            self.rows_per_flush = min(MAX_ROWS_PER_FLUSH, max(
+                ROWS_PER_FLUSH, FLUSH_BYTES_PER_COL // max(1, est_row_size // len(self.col_sizes))))
 
         # if self.statement_type == 'SELECT':
         self.parsed_rows = []
+        self.parsed_head = 0  # Rows before this index in parsed_rows were already returned
         self.parsed_row_amount = 0
     
 
     ## Select
 
-    def _fetch(self, sock=None):
+    def _fetch(self, sock=None, reuse_buffer=True):
+        ''' Get the next chunk of result columns into self.data_columns. With reuse_buffer, the columns are 
+            views into the socket's scratch buffer and must be consumed before the next message is read '''
 
         sock = sock or self.s
         # JSON correspondence
-        res = json.loads(self._send_string('{"fetch" : "fetch"}'))
+        res = _loads(self._send_string('{"fetch" : "fetch"}'))
         num_rows_fetched, column_sizes = res['rows'], res['colSzs']
 
         if num_rows_fetched == 0:
@@ -720,13 +1128,17 @@ class Connection:
             return num_rows_fetched
 
         # Get preceding header
-        self.s.receive(10)
-
-        # Get data as memoryviews of bytearrays.
-        unsorted_data_columns = [
-            memoryview(self.s.receive(size))
-            for idx, size in enumerate(column_sizes)
-        ]
+        self.s.receive_header()
+
+        # Get data as memoryviews - slices of a single scratch read, or separate owned bytearrays
+        if reuse_buffer:
+            data, start = self.s.receive_reused(sum(column_sizes)), 0
+            unsorted_data_columns = []
+            for size in column_sizes:
+                unsorted_data_columns.append(data[start:start + size])
+                start += size
+        else:
+            unsorted_data_columns = [memoryview(self.s.receive(size)) for size in column_sizes]
 
         # Sort by columns, taking a memoryview and casting to the proper type
         self.data_columns = []
@@ -735,16 +1147,22 @@ class Connection:
                                            self.col_tvc):
             column = []
             if nullable:
-                column.append(unsorted_data_columns.pop(0))
+                column.append(np.frombuffer(unsorted_data_columns.pop(0), dtype=np.bool_) if ARROW else
+                              unsorted_data_columns.pop(0))
             if tvc:
-                column.append(unsorted_data_columns.pop(0).cast('i'))
+                column.append(np.frombuffer(unsorted_data_columns.pop(0), dtype=np.int32) if ARROW else
+                              unsorted_data_columns.pop(0).cast('i'))
 
             column.append(unsorted_data_columns.pop(0))
 
-            if type_tup[0] not in ('ftVarchar', 'ftBlob'):
-                column[-1] = column[-1].cast(type_to_letter[type_tup[0]])
-            else:
+            if type_tup[0] == 'ftBlob' or (type_tup[0] == 'ftVarchar' and not ARROW):
                 column[-1] = column[-1].tobytes()
+            elif ARROW:
+                # Numpy views of the fetched data, so parsing it is vectorized from here on
+                column[-1] = np.frombuffer(column[-1], dtype=f'S{type_tup[1]}' if type_tup[0] == 'ftVarchar'
+                                           else sqream_to_np[type_tup[0]])
+            else:
+                column[-1] = column[-1].cast(type_to_letter[type_tup[0]])
             self.data_columns.append(column)
 
         self.unparsed_row_amount = num_rows_fetched
@@ -762,35 +1180,49 @@ class Connection:
         for idx, raw_col_data in enumerate(self.data_columns):
             # Extract data according to column type
             if self.col_tvc[idx]:  # nvarchar
-                nvarc_sizes = raw_col_data[1]
-                col = [
-                    raw_col_data[-1][start:end].decode('utf8')
-                    for (start, end) in lengths_to_pairs(nvarc_sizes)
-                ]
+                nvarc_sizes = raw_col_data[-2]
+                if ARROW:
+                    col = nvarchar_to_arrow(nvarc_sizes, raw_col_data[-1]).to_pylist()
+                else:
+                    col = [
+                        raw_col_data[-1][start:end].decode('utf8')
+                        for (start, end) in lengths_to_pairs(nvarc_sizes)
+                    ]
             elif self.col_type_tups[idx][0] == "ftVarchar":
                 varchar_size = self.col_type_tups[idx][1]
-                col = [
-                    raw_col_data[-1][idx:idx + varchar_size].decode(
-                        self.varchar_enc).rstrip('\x00').rstrip()
-                    for idx in range(0, len(raw_col_data[-1]), varchar_size)
-                ]
+                if ARROW:
+                    # Fixed width bytes view, numpy drops the trailing nulls of each item
+                    col = sq_varchars_to_str(raw_col_data[-1], self.varchar_enc)
+                else:
+                    col = [
+                        raw_col_data[-1][idx:idx + varchar_size].decode(
+                            self.varchar_enc).rstrip('\x00').rstrip()
+                        for idx in range(0, len(raw_col_data[-1]), varchar_size)
+                    ]
             elif self.col_type_tups[idx][0] == "ftDate":
-                col = [sq_date_to_tuple(d) for d in raw_col_data[-1]]
+                if ARROW:
+                    col = sq_dates_to_datetime64(raw_col_data[-1]).astype(object)
+                else:
+                    col = [sq_date_to_tuple(d) for d in raw_col_data[-1]]
             elif self.col_type_tups[idx][0] == "ftDateTime":
-                col = [sq_datetime_to_tuple(d) for d in raw_col_data[-1]]
+                if ARROW:
+                    col = sq_datetimes_to_datetime64(raw_col_data[-1]).astype(object)
+                else:
+                    col = [sq_datetime_to_tuple(d) for d in raw_col_data[-1]]
 
             else:
                 col = raw_col_data[-1]
 
-            # Fill Nones if / where needed
-            if self.col_nul[idx]:
-                nulls = raw_col_data[0]  # .tolist()
-                col = [
-                    item if not null else None
-                    for item, null in zip(col, nulls)
-                ]
-            else:
-                pass
+            # Fill Nones if / where needed - in one vectorized pass for numpy columns, otherwise only
+            # the null positions are visited
+            if ARROW and isinstance(col, np.ndarray):
+                if self.col_nul[idx]:
+                    col = np.where(raw_col_data[0], None, col)
+                col = col.tolist()
+            elif self.col_nul[idx]:
+                col = col if isinstance(col, list) else list(col)
+                for null_idx in compress(range(len(col)), raw_col_data[0]):
+                    col[null_idx] = None
 
             self.extracted_cols.append(col)
 
@@ -800,12 +1232,50 @@ class Connection:
 
         return self.extracted_cols
 
+    def _fetched_cols_to_arrow(self, num_rows):
+        ''' Build an Arrow RecordBatch from the fetched columns. Used by fetch_arrow() '''
+
+        arrays = []
+        for raw_col_data, type_tup, nullable, tvc in zip(self.data_columns, self.col_type_tups,
+                                                          self.col_nul, self.col_tvc):
+            col_type = type_tup[0]
+            # SQream sends a null byte per row, Arrow takes a validity bitmap
+            nulls = raw_col_data[0] if nullable else None
+            validity = pa.py_buffer(np.packbits(~nulls, bitorder='little')) if nullable else None
+
+            if tvc:
+                arr = nvarchar_to_arrow(raw_col_data[-2], raw_col_data[-1], validity)
+            elif col_type == 'ftVarchar':
+                arr = pa.array(sq_varchars_to_str(raw_col_data[-1], self.varchar_enc), type=pa.string(), mask=nulls)
+            elif col_type == 'ftDate':
+                arr = pa.array(sq_dates_to_datetime64(raw_col_data[-1]), mask=nulls)
+            elif col_type == 'ftDateTime':
+                arr = pa.array(sq_datetimes_to_datetime64(raw_col_data[-1]), mask=nulls)
+            elif col_type == 'ftBool':  # Arrow bools are bit packed
+                arr = pa.array(raw_col_data[-1], mask=nulls)
+            else:
+                # Fixed width numbers are used as is
+                arr = pa.Array.from_buffers(sqream_to_pa[col_type], num_rows,
+                                            [validity, pa.py_buffer(raw_col_data[-1])])
+            arrays.append(arr)
+
+        # Done with the raw data buffers
+        self.unparsed_row_amount = 0
+        self.data_columns = []
+
+        return pa.RecordBatch.from_arrays(arrays, schema=self._arrow_schema())
+
+    def _arrow_schema(self):
+
+        return pa.schema([pa.field(name, sqream_to_pa_fetched[type_tup[0]], nullable)
+                          for name, type_tup, nullable in zip(self.col_names, self.col_type_tups, self.col_nul)])
+
     def _fetch_and_parse(self, requested_row_amount, data_as='rows'):
         ''' See if this amount of data is available or a fetch from sqream is required 
             -1 - fetch all available data. Used by fetchmany() '''
 
         if data_as == 'rows':
-            while (requested_row_amount > len(self.parsed_rows)
+            while (requested_row_amount > len(self.parsed_rows) - self.parsed_head
                    or requested_row_amount == -1) and self.more_to_fetch:
                 self.more_to_fetch = bool(self._fetch())  # _fetch() updates self.unparsed_row_amount
 
@@ -814,30 +1284,42 @@ class Connection:
 
     ## Insert
 
-    def _send_columns(self, cols=None, capacity=None):
-        ''' Perform network insert - "put" json, header, binarized columns. Used by executemany() '''
-
-        cols = cols or self.cols
-        cols = cols if isinstance(cols, (list, tuple, set, dict)) else list(cols)
+    def _send_packed_columns(self, packed_cols, capacity):
+        ''' Send a chunk of packed columns - "put" json, header, binarized columns. Run by the sender thread '''
 
-        capacity = capacity or self.capacity
+        byte_count = sum(len(packed_col) for packed_col in packed_cols)
 
-        # Send columns and metadata to be packed into our buffer
-        packed_cols = self.buffer.pack_columns(cols, capacity, self.col_types,
-                                               self.col_sizes, self.col_nul,
-                                               self.col_tvc)
+        # Sending put message, then the binary header and packed data (binary buffer) together
+        self._send_string(_dumps({"put": capacity}), False)
+        self.s.send_buffers([self.s.generate_message_header(byte_count, False)] + packed_cols)
 
-        byte_count = sum(len(packed_col) for packed_col in packed_cols)
+        self.s.validate_response(self.s.get_response(), '{"putted":"putted"}')
 
-        # Sending put message and binary header
-        self._send_string(f'{{"put":{capacity}}}', False)
-        self.s.send((self.s.generate_message_header(byte_count, False)))
 
-        # Sending packed data (binary buffer)
-        for packed_col in packed_cols:
-            self.s.send((packed_col))
+    def _send_columns_chunked(self, col_batches):
+        ''' Send batches of columns as chunks of rows_per_flush rows, each sent by the sender thread while the next
+            is packed - or the next batch produced. Used by executemany() and csv_to_table() '''
 
-        self.s.validate_response(self.s.get_response(), '{"putted":"putted"}')
+        sending = None
+        try:
+            for cols in col_batches:
+                # Slicing at an advancing offset leaves the columns themselves untouched -
+                # numpy chunks are views, and no tail is ever recopied
+                total = len(cols[0]) if len(cols) else 0
+                for start in range(0, total, self.rows_per_flush):
+                    col_chunk = [col[start:start + self.rows_per_flush] for col in cols]
+                    capacity = len(col_chunk[0])
+                    packed_cols = self.buffer.pack_columns(col_chunk, capacity, self.col_types,
+                                                           self.col_sizes, self.col_nul, self.col_tvc)
+
+                    # The previous chunk was sent while this one was packed. Keeping a single chunk in flight
+                    # uses the socket in order, and leaves the other packing buffer free
+                    if sending:
+                        sending.result()
+                    sending = self.sender.submit(self._send_packed_columns, packed_cols, capacity)
+        finally:
+            if sending:
+                sending.result()
 
 
     ## Closing
@@ -857,6 +1339,7 @@ class Connection:
         self._send_string('{"closeConnection":  "closeConnection"}')
         self.s.close()
         self.buffer.close()
+        self.sender.shutdown()
         self.closed = True
         self.base_conn_open[0] = False if self.base_connection else True  
 
@@ -882,41 +1365,52 @@ class Connection:
             'ftBlob':     pa.utf8()
         }
 
+        def probe_schema():
+            con.execute(f'select * from {table_name} where 1=0')
+            con.table_schemas[table_name] = con.col_names, con.col_type_tups
+
+            return con.table_schemas[table_name]
+
         start = time.time()
-        # Get table metadata
+        # Get table metadata, probed once per table by each connection. The insert brings the table's current
+        # types, so a table recreated since with other columns is probed again
         con = con or self
-        con.execute(f'select * from {table_name} where 1=0')
-        
+        cached = table_name in con.table_schemas
+        col_names, col_type_tups = con.table_schemas[table_name] if cached else probe_schema()
+        try:
+            con.execute(f'insert into {table_name} values ({",".join(["?"] * len(col_names))})')
+            stale = cached and tuple(con.col_type_tups) != tuple(col_type_tups)
+        except Exception:
+            # Preparing the insert fails on a column count no longer matching the table
+            if not cached:
+                raise
+            stale = True
+        if stale:
+            col_names, col_type_tups = probe_schema()
+            con.execute(f'insert into {table_name} values ({",".join(["?"] * len(col_names))})')
+
         # Map column names to pyarrow types and set Arrow's CSV parameters
-        sqream_col_types = [col_type[0] for col_type in con.col_type_tups]
-        column_types = zip(con.col_names, [sqream_to_pa[col_type[0]] for col_type in con.col_type_tups])
-        read = read or csv.ReadOptions(column_names=con.col_names)
+        sqream_col_types = [col_type[0] for col_type in col_type_tups]
+        column_types = zip(col_names, [sqream_to_pa[col_type[0]] for col_type in col_type_tups])
+        read = read or csv.ReadOptions(column_names=col_names)
         parse = parse or csv.ParseOptions(delimiter='|')
         convert = convert or csv.ConvertOptions(column_types = None if auto_infer else column_types)
         
-        # Read CSV to in-memory arrow format
-        csv_arrow = csv.read_csv(csv_path, read_options=read, parse_options=parse, convert_options=convert).combine_chunks()
-        num_chunks = len(csv_arrow[0].chunks)
-        numpy_cols = []
-
-        # For each column, get the numpy representation for quick packing 
-        for col_type, col in zip(sqream_col_types, csv_arrow):
-            # Only one chunk after combine_chunks()
-            col = col.chunks[0]
-            if col_type in  ('ftVarchar', 'ftBlob', 'ftDate', 'ftDateTime'):
-                col = col.to_pandas()
-            else:
-                col = col.to_numpy()
-            
-            numpy_cols.append(col)
-        
-        print (f'total loading csv: {time.time()-start}')
-        start = time.time()
-        
+        # Stream the CSV as Arrow record batches, each sent as soon as it's parsed
+        reader = csv.open_csv(csv_path, read_options=read, parse_options=parse, convert_options=convert,
+                              memory_pool=arrow_memory_pool)
+
+        # For each column, get the numpy representation for quick packing. Columns are converted in parallel
+        # by the packing threads, Arrow doing the work without the GIL. Batches are converted as the insert
+        # consumes them, so only the one being packed and the one being sent are held
+        convert_cols = con.buffer.executor.map if con.buffer.executor else map
+        numpy_batches = (list(convert_cols(_arrow_to_numpy, zip(sqream_col_types, batch.columns))) for batch in reader)
+
         # Insert columns into SQream
-        col_num = csv_arrow.shape[1]
-        con.executemany(f'insert into {table_name} values ({"?,"*(col_num-1)}?)', numpy_cols)
-        print (f'total inserting csv: {time.time()-start}')
+        con._send_columns_chunked(numpy_batches)
+
+        con.close_statement()
+        printdbg(f'total loading and inserting csv: {time.time()-start}')
 
     # '''
 
@@ -960,19 +1454,9 @@ class Connection:
             self.description = None
             return self.description
 
-        self.description = []
-        for col_name, col_nullalbe, col_type_tup in zip(
-                self.col_names, self.col_nul, self.col_type_tups):
-            type_code = typecodes[
-                col_type_tup[0]]  # Convert SQream type to DBAPI identifier
-            display_size = internal_size = col_type_tup[
-                1]  # Check if other size is available from API
-            precision = None
-            scale = None
-
-            self.description.append(
-                (col_name, type_code, display_size, internal_size, precision,
-                 scale, col_nullalbe))
+        # The JSON type lists are made hashable for the cache, the cached tuple is copied to stay unmodified
+        self.description = list(_build_description(
+            tuple(self.col_names), tuple(self.col_nul), tuple(map(tuple, self.col_type_tups))))
 
         return self.description
 
@@ -1017,28 +1501,28 @@ class Connection:
         if rows_or_cols is None:
             return self
 
-        if 'numpy' in repr(type(rows_or_cols[0])):
+        # len() rather than truthiness, which numpy arrays don't have. The insert just started has nothing to send
+        if len(rows_or_cols) == 0:
+            self.close_statement()
+            return self
+
+        if ARROW and isinstance(rows_or_cols[0], np.ndarray):
             data_as = 'numpy'
 
         # Network insert starts here if data was passed
-        if len(set(len(row_or_col) for row_or_col in rows_or_cols)) > 1: 
+        seq_len = len(rows_or_cols[0])
+        if any(len(row_or_col) != seq_len for row_or_col in rows_or_cols):
             raise ProgrammingError(
                 "Incosistent data sequences passed for inserting. Please use rows/columns of consistent length"
             )
         if data_as == 'rows':
-            self.capacity = amount or len(rows_or_cols)
-            self.cols = list(zip(*rows_or_cols))
+            # Numpy transposes in C, each column being a view of a single object array
+            self.cols = list(np.array(rows_or_cols, dtype=object).T) if ARROW else list(zip(*rows_or_cols))
         else:
             self.cols = rows_or_cols
-            self.capacity = len(self.cols)
 
-        # Slice a chunk of columns and pass to _send_columns()
-        while self.cols != [()]:
-            col_chunk = [col[:self.rows_per_flush] for col in self.cols]
-            if len(col_chunk[0]) == 0:
-                break
-            self._send_columns(col_chunk, len(col_chunk[0]))
-            self.cols = [col[self.rows_per_flush:] for col in self.cols]
+        self._send_columns_chunked([self.cols])
+        self.cols = []
 
         self.close_statement()
 
@@ -1058,10 +1542,15 @@ class Connection:
      
         self._fetch_and_parse(size, data_as)
 
-        # Get relevant part of parsed rows and reduce storage and counter
+        # Get relevant part of parsed rows and advance past it. The returned rows are dropped only once they're
+        # most of the list, so the remaining ones aren't recopied on every call
         if data_as == 'rows':
-            res = self.parsed_rows[0:size if size != -1 else None]
-            self.parsed_rows = self.parsed_rows[size:] if size != -1 else []
+            end = len(self.parsed_rows) if size == -1 else min(self.parsed_head + size, len(self.parsed_rows))
+            res = self.parsed_rows[self.parsed_head:end]
+            self.parsed_head = end
+            if 2 * self.parsed_head >= len(self.parsed_rows):
+                del self.parsed_rows[:self.parsed_head]
+                self.parsed_head = 0
 
         # print ('------ fetch result:', res)
         
@@ -1083,6 +1572,50 @@ class Connection:
 
         return self.fetchmany(-1, data_as)
 
+    def fetch_arrow(self):
+        ''' Fetch the next chunk of result rows as a pyarrow RecordBatch, None when all were fetched.
+            Can follow fetchone() / fetchmany(), rows they left over from their chunk making up the first batch '''
+
+        if not ARROW:
+            raise NotSupportedError("Optional pyarrow dependency not found. To install: pip3 install pyarrow")
+
+        self._verify_open()
+
+        if self.more_to_fetch is False:
+            return None
+
+        self._verify_query_type('SELECT')
+
+        # Rows parsed but not yet returned come first, so the result stays in order
+        if self.parsed_head < len(self.parsed_rows):
+            rows = self.parsed_rows[self.parsed_head:]
+            self.parsed_rows, self.parsed_head = [], 0
+            schema = self._arrow_schema()
+
+            return pa.RecordBatch.from_arrays([pa.array(col, type=field.type)
+                                               for col, field in zip(zip(*rows), schema)], schema=schema)
+
+        # Arrow arrays wrap the fetched buffers without copying, so they need buffers of their own
+        num_rows_fetched = self._fetch(reuse_buffer=False)
+        self.more_to_fetch = bool(num_rows_fetched)
+
+        return self._fetched_cols_to_arrow(num_rows_fetched) if num_rows_fetched else None
+
+    def fetchall_arrow(self):
+        ''' Fetch all remaining result rows as a pyarrow Table '''
+
+        if not ARROW:
+            raise NotSupportedError("Optional pyarrow dependency not found. To install: pip3 install pyarrow")
+
+        # Same checks as fetch_arrow() makes, before the schema needs the statement's columns
+        self._verify_open()
+        if self.more_to_fetch is not False:
+            self._verify_query_type('SELECT')
+
+        schema = self._arrow_schema()
+
+        return pa.Table.from_batches(list(iter(self.fetch_arrow, None)), schema=schema)
+
     def cursor(self):
         ''' Return a new connection with the same parameters.
             We use a connection as the equivalent of a 'cursor' '''
@@ -1145,8 +1678,14 @@ class Connection:
         self.close()
 
     def __iter__(self):
-        for item in self.fetchall():
-            yield item
+        ''' Stream the result rows, only a batch of them held at a time. fetchmany(1) returns a row 
+            rather than a list, so batches are never that small '''
+
+        while True:
+            rows = self.fetchmany(max(self.arraysize, FETCH_ITER_DEFAULT))
+            if not rows:
+                break
+            yield from rows
 
 
 ## Top level functionality
@@ -1,7 +1,8 @@
-import os, sys
+import os, sys, tempfile
 import numpy as np
+from pyarrow import csv as pa_csv
 from time import sleep
-from datetime import datetime, date
+from datetime import datetime, date, timezone, timedelta
 from subprocess import Popen, PIPE
 # from random import random, randint
 from numpy.random import rand, randint, uniform
@@ -147,6 +148,59 @@ def positive_tests():
             TESTS_PASS = False
 
 
+    print ('\nPositive Numpy Tests')
+    print ('--------------------')
+
+    # NaN, NaT and masked items are inserted as nulls
+    ints = np.array([1, -5, 7], dtype=np.int32)
+    masked = np.ma.masked_array(np.array([2, 3, 4], dtype=np.int64), mask=[False, True, False])
+    doubles = np.array([1.5, float('nan'), -2.25])
+    dates = np.array(['2016-12-23', 'NaT', '1998-09-24'], dtype='datetime64[D]')
+    datetimes = np.array(['2016-12-23T16:56:45', '1998-09-24T17:25:46', 'NaT'], dtype='datetime64[s]')
+    expected = [(1, 2, 1.5, date(2016, 12, 23), datetime(2016, 12, 23, 16, 56, 45)),
+                (-5, None, None, None, datetime(1998, 9, 24, 17, 25, 46)),
+                (7, 4, -2.25, date(1998, 9, 24), None)]
+    con.execute('create or replace table test (i int, bi bigint, d double, dt date, dtt datetime)')
+    con.executemany('insert into test values (?, ?, ?, ?, ?)', [ints, masked, doubles, dates, datetimes])
+    con.execute('select * from test')
+    res = con.fetchall()
+
+    if res != expected:
+        print (f"TEST ERROR: numpy insert, expected {expected} but got {res}")
+        TESTS_PASS = False
+
+    print ('\nPositive Fetch Tests')
+    print ('--------------------')
+
+    # fetchmany() and iterating carry on from each other
+    rows = [(idx, ) for idx in range(10)]
+    con.execute('create or replace table test (i int)')
+    con.executemany('insert into test values (?)', rows)
+    con.execute('select * from test')
+    res = con.fetchmany(3) + con.fetchmany(2) + [row for row in con]
+
+    if res != rows:
+        print (f"TEST ERROR: fetchmany and iteration, expected {rows} but got {res}")
+        TESTS_PASS = False
+
+    print ('\nPositive CSV Tests')
+    print ('------------------')
+
+    # A small block size has the CSV read and inserted over several batches
+    rows = [(idx, f'row {idx}') for idx in range(1000)]
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+        csv_file.writelines(f'{i}|{s}\n' for i, s in rows)
+    con.execute(f'create or replace table test (i int, s nvarchar({nvarchar_length}))')
+    con.csv_to_table(csv_file.name, 'test', read=pa_csv.ReadOptions(column_names=['i', 's'], block_size=1 << 10))
+    os.remove(csv_file.name)
+    con.execute('select * from test')
+    res = sorted(con.fetchall())
+
+    if res != rows:
+        print (f"TEST ERROR: multi batch csv_to_table, expected {len(rows)} rows but got {len(res)}: {res[:5]}")
+        TESTS_PASS = False
+
+
 
 def negative_tests():
     ''' Negative Set/Get Tests '''
@@ -207,9 +261,62 @@ def parametered_test():
 
 
 
+def arrow_test():
+    ''' Fetching as Arrow should get the same data as fetching rows '''
+
+    global TESTS_PASS
+
+    print ('\nArrow Fetch Tests')
+    print ('-----------------')
+
+    rows = [(True, 5, 'yada', 'אבג', date(2016, 12, 23), datetime(2016, 12, 23, 16, 56, 45)),
+            (None, None, None, None, None, None)] * 3
+    con.execute(f'create or replace table test (b bool, i int, s varchar(10), ss nvarchar(10), d date, dt datetime)')
+    con.executemany('insert into test values (?, ?, ?, ?, ?, ?)', rows)
+    con.execute('select * from test')
+    res = [tuple(row.values()) for row in con.fetchall_arrow().to_pylist()]
+
+    if res != rows:
+        print (f"arrow test fail, expected {rows} but got {res}")
+        TESTS_PASS = False
+
+    # Rows left over by fetchone() come first
+    con.execute('select * from test')
+    res = [con.fetchone()] + [tuple(row.values()) for row in con.fetchall_arrow().to_pylist()]
+
+    if res != rows:
+        print (f"arrow after fetchone test fail, expected {rows} but got {res}")
+        TESTS_PASS = False
+
+
+
+def timezone_test():
+    ''' Timezone aware datetimes should be stored at their wall clock time, as timetuple() gives it '''
+
+    global TESTS_PASS
+
+    print ('\nTimezone Tests')
+    print ('--------------')
+
+    tz = timezone(timedelta(hours=2))
+    rows = [(datetime(2020, 1, 1, 10, tzinfo=tz), datetime(2020, 1, 1, 1, tzinfo=tz)), (None, None)]
+    expected = [(date(2020, 1, 1), datetime(2020, 1, 1, 1)), (None, None)]
+    con.execute(f'create or replace table test (d date, dt datetime)')
+    con.executemany('insert into test values (?, ?)', rows)
+    con.execute('select * from test')
+    res = con.fetchall()
+
+    if res != expected:
+        print (f"timezone test fail, expected {expected} but got {res}")
+        TESTS_PASS = False
+
+
+
 tests = {'pos'    : positive_tests, 
         'param'   : parametered_test,
-        'neg'     : negative_tests    
+        'neg'     : negative_tests,
+        'arrow'   : arrow_test,
+        'tz'      : timezone_test
         }
 
 
@@ -217,7 +324,7 @@ tests = {'pos'    : positive_tests,
 def main():
 
     args = sys.argv
-    tests_to_run = 'pos', 'neg'  #, 'param', 
+    tests_to_run = 'pos', 'neg', 'arrow', 'tz'  #, 'param', 
     # tests_to_run = 'neg'
 
     # Get SQream path and test names to run if given